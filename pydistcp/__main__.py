@@ -1,57 +1,169 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-"""pydistcp: A python Web HDFS based tool for inter/intra-cluster data copying.
-
-Usage:
-  pydistcp [-fp] [--files-only] [--no-checksum] [--silent] (-s CLUSTER -d CLUSTER) [-v...] [--conf=CONFIGURATION] [--part-size=PART_SIZE] [--buffer-size=BUFFER_SIZE] [--min-size=SIZE] [--include-pattern=PATTERN] [--threads=THREADS] SRC_PATH DEST_PATH
-  pydistcp (--version | -h)
-
-Options:
-  --version                     Show version and exit.
-  -h --help                     Show help and exit.
-  -s CLUSTER --src=CLUSTER      Alias of source namenode to connect to (valid only with dist).
-  -d CLUSTER --dest=CLUSTER     Alias of destination namenode to connect to (valid only with dist).
-  -v --verbose                  Enable log output. Can be specified up to three
-                                times (increasing verbosity each time).
-  --no-checksum                 Disable checksum check prior to file transfer. This will force
-                                overwrite.
-  --files-only                  Do not create the same directory strecture at the destination and copy
-                                files only under DEST_PATH.
-  --silent                      Don't display progress status.
-  -f --force                    Allow overwriting any existing files.
-  -p --preserve                 Preserve file attributes.
-  --threads=THREADS             Number of threads to use for parallelization.
-                                0 allocates a thread per file. [default: 0]
-  --include-pattern=PATTERN     Filter input files based on a pattern. [default: *]
-  --min-size=SIZE               Filter input files based on minimum size. [default: 0]
-  --part-size=PART_SIZE         Interval in bytes by which the files will be copied
-                                needs to be a Powers of 2. [default: 65536]
-  --buffer-size=BUFFER_SIZE     The buffer size in bytes used for hdfs read and write operations
-                                needs to be a Powers of 2. [default: 65536]
-  --conf=CONFIGURATION          pywhdfs configuration file to use. Defauls to ~/.webhdfs.cfg and could
-                                be set using the environement variable WEBHDFS_CONFIG.
-
-Examples:
-  pydistcp -s prod -d preprod -v /tmp/src /tmp/dest
-
-"""
+"""pydistcp: A python Web HDFS based tool for inter/intra-cluster data copying."""
 
 from . import __version__
 from pywhdfs.config import WebHDFSConfig
 from pywhdfs.utils.utils import *
-from docopt import docopt
-from .distclient import WebHDFSDistClient
-from .utils import _Progress
+from .checksum import CHECKSUM_ALGORITHMS
+from .distclient import WebHDFSDistClient, download_ranged, MAX_THREADS, VERIFY_METHODS
+from .localcopy import copy_local
+from .utils import _Progress, compile_pattern, configure_transfer, STREAM_CHUNK_SIZE
+import argparse
 import logging as lg
 import requests as rq
 import json
 import sys
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Optional, Pattern
 
-def configure(args, path=None):
-  """Instantiate configuration from arguments dictionary.
+try:
+  import orjson
+except ImportError:
+  orjson = None
 
-  :param args: Arguments returned by `docopt`.
+_logger = lg.getLogger(__name__)
+
+_STDERR_TTY = sys.stderr.isatty()
+
+# Keep-alive pools of pywhdfs clients, one per host (the namenode and every
+# datanode reads and writes are redirected to), of as many connections.
+_POOL_CONNECTIONS = 60
+
+def _size(value):
+  """Argument type of the transfer sizes."""
+  size = int(value)
+  if size <= 0:
+    raise argparse.ArgumentTypeError('%r is not a positive size.' % (value,))
+  return size
+
+_PARSER = argparse.ArgumentParser(
+  prog='pydistcp',
+  description=__doc__,
+  epilog='Examples:\n  pydistcp -s prod -d preprod -v /tmp/src /tmp/dest',
+  formatter_class=argparse.RawDescriptionHelpFormatter,
+)
+_PARSER.add_argument('--version', action='version', version='%(prog)s ' + __version__,
+  help='Show version and exit.')
+_PARSER.add_argument('-s', '--src', metavar='CLUSTER', required=True,
+  help='Alias of source namenode to connect to, or local.')
+_PARSER.add_argument('-d', '--dest', metavar='CLUSTER', required=True,
+  help='Alias of destination namenode to connect to, or local.')
+_PARSER.add_argument('-v', '--verbose', action='count', default=0,
+  help='Enable log output. Can be specified up to three times (increasing verbosity each time).')
+_PARSER.add_argument('--no-checksum', action='store_true',
+  help='Disable checksum check prior to file transfer. This will force overwrite.')
+_PARSER.add_argument('--checksum-algo', metavar='ALGO', choices=CHECKSUM_ALGORITHMS, default='crc32c',
+  help='Checksum computed on the data while it is copied between clusters, '
+       'one of crc32c, md5 or none. (default: %(default)s)')
+_PARSER.add_argument('--verify', metavar='METHOD', choices=VERIFY_METHODS, default='none',
+  help='Check every file copied between clusters against its source, one of server (compare the '
+       'checksums computed by the datanodes, reading the copy back when they can not be compared), '
+       'stream (read the copy back) or none. (default: %(default)s)')
+_PARSER.add_argument('--files-only', action='store_true',
+  help='Do not create the same directory strecture at the destination and copy files only under DEST_PATH.')
+_PARSER.add_argument('--silent', action='store_true',
+  help="Don't display progress status.")
+_PARSER.add_argument('-f', '--force', action='store_true',
+  help='Allow overwriting any existing files.')
+_PARSER.add_argument('-p', '--preserve', action='store_true',
+  help='Preserve file attributes.')
+_PARSER.add_argument('--threads', metavar='THREADS', type=int, default=0,
+  help='Number of threads to use for parallelization. 0 allocates a thread per file, up to 32. '
+       'Each cluster keeps at least one connection alive per thread. (default: %(default)s)')
+_PARSER.add_argument('--include-pattern', metavar='PATTERN', default='*',
+  help='Filter input files based on a pattern. (default: %(default)s)')
+_PARSER.add_argument('--min-size', metavar='SIZE', type=int, default=0,
+  help='Filter input files based on minimum size. (default: %(default)s)')
+_PARSER.add_argument('--part-size', metavar='PART_SIZE', type=_size,
+  help='Smallest amount of data in bytes worth a request of its own, a single large file read '
+       'from a cluster is split across threads into parts of at least this size. Needs to be a '
+       'Powers of 2. Data is held in memory in chunks of at most 1 MiB, or of this size if '
+       'smaller. Defaults to a size tuned from the measured source bandwidth.')
+_PARSER.add_argument('--buffer-size', metavar='BUFFER_SIZE', type=_size,
+  help='The buffer size in bytes used for hdfs read and write operations needs to be a Powers of 2. '
+       'Defaults to the chunk size, at most 1 MiB.')
+_PARSER.add_argument('--conf', metavar='CONFIGURATION',
+  help='pywhdfs configuration file to use. Defauls to ~/.webhdfs.cfg and could be set using '
+       'the environement variable WEBHDFS_CONFIG.')
+_PARSER.add_argument('src_path', metavar='SRC_PATH')
+_PARSER.add_argument('dest_path', metavar='DEST_PATH')
+
+@dataclass(frozen=True)
+class CopyConfig(object):
+
+  """Options of a copy job, read-only once resolved.
+
+  Fields mirror the command line options, see :meth:`from_args`. A
+  `n_threads` of `0` (or negative) uses `MAX_THREADS`, and the include
+  pattern is compiled once into `include_pattern_re`. Part and buffer sizes
+  left to `None` are tuned when the transfer starts.
+
+  """
+
+  src: str
+  dest: str
+  src_path: str
+  dest_path: str
+  conf: Optional[str] = None
+  verbose: int = 0
+  n_threads: int = 0
+  part_size: Optional[int] = None
+  buffer_size: Optional[int] = None
+  include_pattern: str = '*'
+  min_size: int = 0
+  force: bool = False
+  silent: bool = False
+  checksum: bool = True
+  checksum_algo: str = 'crc32c'
+  verify: str = 'none'
+  files_only: bool = False
+  preserve: bool = False
+  include_pattern_re: Pattern = field(init=False, repr=False, compare=False)
+
+  def __post_init__(self):
+    # Frozen instances can only be completed through `object.__setattr__`.
+    if self.n_threads <= 0:
+      object.__setattr__(self, 'n_threads', MAX_THREADS)
+    object.__setattr__(self, 'include_pattern_re', compile_pattern(self.include_pattern))
+
+  @classmethod
+  def from_args(cls, args):
+    """Instantiate from the command line arguments.
+
+    :param args: Arguments parsed by `_PARSER`, as a dictionary.
+
+    """
+    checksum = not args['no_checksum']
+    return cls(
+      src=args['src'],
+      dest=args['dest'],
+      src_path=args['src_path'],
+      dest_path=args['dest_path'],
+      conf=args['conf'],
+      verbose=args['verbose'],
+      n_threads=args['threads'],
+      part_size=args['part_size'],
+      buffer_size=args['buffer_size'],
+      include_pattern=args['include_pattern'],
+      min_size=args['min_size'],
+      force=args['force'],
+      silent=args['silent'],
+      checksum=checksum,
+      checksum_algo=args['checksum_algo'] if checksum else 'none',
+      verify=args['verify'],
+      files_only=args['files_only'],
+      preserve=args['preserve'],
+    )
+
+def configure(cfg, path=None):
+  """Instantiate configuration from the job options.
+
+  :param cfg: :class:`CopyConfig` of the job.
   :param config: CLI configuration, used for testing.
 
   If the `--log` argument is set, this method will print active file handler
@@ -78,119 +190,302 @@ def configure(args, path=None):
   # Configure stream logging if applicable
   stream_handler = lg.StreamHandler()
   # This defaults to zero
-  stream_log_level=levels.get(args['--verbose'], lg.DEBUG)
+  stream_log_level=levels.get(cfg.verbose, lg.DEBUG)
   stream_handler.setLevel(stream_log_level)
 
   fmt = '%(levelname)s\t%(message)s'
   stream_handler.setFormatter(lg.Formatter(fmt))
-  logger.addHandler(stream_handler)
+
+  # Worker threads only enqueue their records, a single listener thread
+  # formats and writes them out.
+  log_queue = SimpleQueue()
+  queue_handler = QueueHandler(log_queue)
+  logger.addHandler(queue_handler)
 
   config = WebHDFSConfig(path)
 
   # configure file logging if applicable
   handler = config.get_log_handler()
-  logger.addHandler(handler)
+  handlers = [stream_handler, handler]
+  # Records no handler would emit are dropped before being enqueued.
+  queue_handler.setLevel(min(
+    h.level for h in handlers if not isinstance(h, lg.NullHandler)
+  ))
+  config.log_handler = queue_handler
+  config.log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+  config.log_listener.start()
   return config
 
-def main(argv=None):
-  """Entry point.
-  :param argv: Arguments list.
-  :param client: For testing.
+def transfer_sizes(cfg, client=None, src_status=None):
+  """Resolve the part, chunk and buffer sizes of a transfer.
+
+  :param cfg: :class:`CopyConfig` of the job.
+  :param client: Client of the source cluster, used to measure the bandwidth
+    when the part size was not set explicitly. Local sources are not
+    measured.
+  :param src_status: Status of the source path, `None` when it is a pattern
+    or a local path.
+
+  The part size is the smallest amount of data worth a request of its own,
+  it decides how a single large file is split across streams (see
+  :func:`ranged_streams`). Only single source files are measured, other
+  transfers send one request per file and leave the part size `None` unless
+  it was set. The chunks in which data is held in memory are capped at
+  `STREAM_CHUNK_SIZE`, and the buffer size defaults to the chunk size.
+
+  Sizes set explicitly are rounded up to a power of 2, which keeps the
+  transferred parts aligned with HDFS checksum chunks and blocks.
+
   """
+  part_size = _pow2_size('part', cfg.part_size)
+  buffer_size = _pow2_size('buffer', cfg.buffer_size)
+  if part_size is None and _is_file(src_status):
+    cache_key = '%s:%s' % (cfg.src, cfg.dest)
+    part_size = configure_transfer(client, cfg.src_path, cache_key=cache_key)
+  chunk_size = min(part_size or STREAM_CHUNK_SIZE, STREAM_CHUNK_SIZE)
+  return part_size, chunk_size, buffer_size or chunk_size
+
+def ranged_streams(src_status, part_size, n_threads):
+  """Number of parallel streams to split a single source file into.
+
+  :param src_status: Status of the source path, `None` when it is a pattern.
+  :param part_size: Part size of the transfer.
+  :param n_threads: Number of threads used for the transfer.
+
+  Every stream gets at least one part of the file. Returns `0` when the
+  source is not a single file, and `1` when it is too small to be split.
+
+  """
+  if not _is_file(src_status):
+    return 0
+  return max(min(n_threads, int(src_status['length']) // part_size), 1)
+
+def _do_dist(cfg, config):
+  """Copy between two clusters.
+
+  :param cfg: :class:`CopyConfig` of the job.
+  :param config: pywhdfs configuration, see :func:`configure`.
+
+  This function returns the job status.
+
+  """
+  src_client = config.get_client(cfg.src, pool_connections=max(_POOL_CONNECTIONS, cfg.n_threads))
+  dest_client = config.get_client(cfg.dest, pool_connections=max(_POOL_CONNECTIONS, cfg.n_threads))
+  client = WebHDFSDistClient(src_client, dest_client)
+  src_status = src_client.status(cfg.src_path, strict=False)
+  part_size, chunk_size, buffer_size = transfer_sizes(cfg, src_client, src_status)
+
+  if _STDERR_TTY and not cfg.silent:
+    progress = _Progress.from_hdfs(client.src, cfg.src_path, n_threads=cfg.n_threads)
+  else:
+    progress = None
 
-  args = docopt(__doc__, argv=argv, version=__version__)
-
-  conf_file = args['--conf']
-  config = configure(args, conf_file)
-
-  n_threads = int(args['--threads'])
-  part_size = int(args['--part-size'])
-  buffer_size = int(args['--buffer-size'])
-  include_pattern = args['--include-pattern']
-  min_size = int(args['--min-size'])
-  force = args['--force']
-  silent = args['--silent']
-  checksum = False if args['--no-checksum'] else True
-  files_only = True if args['--files-only'] else False
-  src_path = args['SRC_PATH']
-  dest_path = args['DEST_PATH']
-
-  if args["--src"] != 'local' and args["--dest"] != 'local':
-    src_client = config.get_client(args["--src"])
-    dest_client = config.get_client(args["--dest"])
-    client = WebHDFSDistClient(src_client, dest_client)
-
-    if sys.stderr.isatty() and not silent:
-      progress = _Progress.from_hdfs(client.src,src_path)
+  # The progress bar is finished before the final job status is printed.
+  with progress or nullcontext():
+    n_streams = ranged_streams(src_status, part_size, cfg.n_threads)
+    if n_streams > 1:
+      status = client.copy_ranged(
+                cfg.src_path,
+                cfg.dest_path,
+                n_streams,
+                overwrite=cfg.force,
+                checksum=cfg.checksum,
+                checksum_algo=cfg.checksum_algo,
+                verify=cfg.verify,
+                chunk_size=chunk_size,
+                buffer_size=buffer_size,
+                progress=progress,
+                preserve=cfg.preserve,
+              )
     else:
-      progress = None
-
-    status = client.copy(
-              src_path,
-              dest_path,
-              overwrite=force,
-              checksum=checksum,
-              chunk_size=part_size,
-              buffer_size=buffer_size,
-              n_threads=n_threads,
+      status = client.copy(
+                cfg.src_path,
+                cfg.dest_path,
+                overwrite=cfg.force,
+                checksum=cfg.checksum,
+                checksum_algo=cfg.checksum_algo,
+                verify=cfg.verify,
+                chunk_size=chunk_size,
+                buffer_size=buffer_size,
+                n_threads=cfg.n_threads,
+                progress=progress,
+                preserve=cfg.preserve,
+              )
+  return status
+
+def _do_upload(cfg, config):
+  """Upload local files to a cluster.
+
+  :param cfg: :class:`CopyConfig` of the job.
+  :param config: pywhdfs configuration, see :func:`configure`.
+
+  This function returns the job status.
+
+  """
+  client = config.get_client(cfg.dest, pool_connections=max(_POOL_CONNECTIONS, cfg.n_threads))
+  _, chunk_size, _ = transfer_sizes(cfg)
+  if _STDERR_TTY and not cfg.silent:
+    progress = _Progress.from_local(cfg.src_path, include_pattern=cfg.include_pattern_re, min_size=cfg.min_size)
+  else:
+    progress = None
+
+  with progress or nullcontext():
+    status = client.upload(
+              cfg.dest_path,
+              cfg.src_path,
+              overwrite=cfg.force,
+              checksum=cfg.checksum,
+              chunk_size=chunk_size,
+              n_threads=cfg.n_threads,
               progress=progress,
-              preserve= True if args['--preserve'] else False,
+              include_pattern=cfg.include_pattern,
+              files_only=cfg.files_only,
+              min_size=cfg.min_size,
+              preserve=cfg.preserve,
             )
+  return status
 
-    # Finilize the progress bar before printing the final job status
-    if progress:
-      del(progress)
-    print ("Job Status:")
-    print (json.dumps(status, indent=2))
+def _do_download(cfg, config):
+  """Download from a cluster to the local filesystem.
+
+  :param cfg: :class:`CopyConfig` of the job.
+  :param config: pywhdfs configuration, see :func:`configure`.
 
-  elif args["--src"] == 'local' and args["--dest"] != 'local':
-    client = config.get_client(args["--dest"])
-    if sys.stderr.isatty() and not silent:
-      progress = _Progress.from_local(src_path, include_pattern=include_pattern, min_size=min_size)
+  Downloads do not report a job status, `None` is returned.
+
+  """
+  client = config.get_client(cfg.src, pool_connections=max(_POOL_CONNECTIONS, cfg.n_threads))
+  src_status = client.status(cfg.src_path, strict=False)
+  part_size, _, buffer_size = transfer_sizes(cfg, client, src_status)
+  if _STDERR_TTY and not cfg.silent:
+    progress = _Progress.from_hdfs(client, cfg.src_path, n_threads=cfg.n_threads)
+  else:
+    progress = None
+
+  with progress or nullcontext():
+    # Responses are streamed to disk as they arrive, in blocks of
+    # STREAM_CHUNK_SIZE to keep the per-block interpreter overhead low. Single
+    # files are written to a preallocated file, even with one stream.
+    n_streams = ranged_streams(src_status, part_size, cfg.n_threads)
+    if n_streams:
+      download_ranged(
+        client,
+        cfg.src_path,
+        cfg.dest_path,
+        n_streams,
+        overwrite=cfg.force,
+        chunk_size=STREAM_CHUNK_SIZE,
+        buffer_size=buffer_size,
+        progress=progress,
+      )
     else:
-      progress = None
+      client.download(
+        cfg.src_path,
+        cfg.dest_path,
+        overwrite=cfg.force,
+        chunk_size=STREAM_CHUNK_SIZE,
+        buffer_size=buffer_size,
+        n_threads=cfg.n_threads,
+        progress=progress,
+        preserve=cfg.preserve,
+      )
+  return None
 
-    status = client.upload(
-              dest_path,
-              src_path,
-              overwrite=force,
-              checksum=checksum,
-              chunk_size=part_size,
-              n_threads=n_threads,
+def _do_local(cfg, config):
+  """Copy between two local paths.
+
+  :param cfg: :class:`CopyConfig` of the job.
+  :param config: pywhdfs configuration, see :func:`configure`.
+
+  This function returns the job status.
+
+  """
+  _, chunk_size, _ = transfer_sizes(cfg)
+  if _STDERR_TTY and not cfg.silent:
+    progress = _Progress.from_local(cfg.src_path, include_pattern=cfg.include_pattern_re, min_size=cfg.min_size)
+  else:
+    progress = None
+
+  with progress or nullcontext():
+    status = copy_local(
+              cfg.src_path,
+              cfg.dest_path,
+              overwrite=cfg.force,
+              chunk_size=chunk_size,
+              n_threads=cfg.n_threads,
               progress=progress,
-              include_pattern=include_pattern,
-              files_only=files_only,
-              min_size=min_size,
-              preserve= True if args['--preserve'] else False,
+              include_pattern=cfg.include_pattern_re,
+              min_size=cfg.min_size,
+              preserve=cfg.preserve,
             )
+  return status
 
-    # Finilize the progress bar before printing the final job status
-    if progress:
-      del(progress)
-    print ("Job Status:")
-    print (json.dumps(status, indent=2))
-  elif args["--src"] != 'local' and args["--dest"] == 'local':
-    client = config.get_client(args["--src"])
-    if sys.stderr.isatty() and not silent:
-      progress = _Progress.from_hdfs(client,src_path)
-    else:
-      progress = None
-
-    client.download(
-      src_path,
-      dest_path,
-      overwrite=force,
-      chunk_size=part_size,
-      n_threads=n_threads,
-      progress=progress,
-      preserve= True if args['--preserve'] else False,
+# Transfer function of each kind of source and destination.
+_DISPATCH = {
+  ('hdfs', 'hdfs'): _do_dist,
+  ('local', 'hdfs'): _do_upload,
+  ('hdfs', 'local'): _do_download,
+  ('local', 'local'): _do_local,
+}
+
+def main(argv=None):
+  """Entry point.
+  :param argv: Arguments list.
+  :param client: For testing.
+  """
+
+  cfg = CopyConfig.from_args(vars(_PARSER.parse_args(argv)))
+  config = configure(cfg, cfg.conf)
+
+  try:
+    mode = (
+      'local' if cfg.src == 'local' else 'hdfs',
+      'local' if cfg.dest == 'local' else 'hdfs',
     )
-  else:
-    print('copy from local to local is not supported, use cp command.')
-    sys.exit(1)
+    status = _DISPATCH[mode](cfg, config)
+    if status is not None:
+      _print_status(status)
+  finally:
+    # Stop queueing records nothing would read anymore, then flush the
+    # pending ones before exiting.
+    lg.getLogger().removeHandler(config.log_handler)
+    config.log_listener.stop()
 
   sys.exit(0)
 
+def _print_status(status):
+  """Print the final job status as indented JSON, using `orjson` when
+  available."""
+  print ("Job Status:")
+  if orjson is None:
+    print (json.dumps(status, indent=2))
+    return
+  data = orjson.dumps(status, option=orjson.OPT_INDENT_2)
+  output = getattr(sys.stdout, 'buffer', None)
+  if output is None:
+    # Text only streams, e.g. when stdout is replaced by an `io.StringIO`.
+    print (data.decode())
+    return
+  sys.stdout.flush()
+  output.write(data + b'\n')
+  output.flush()
+
+def _is_file(status):
+  """Whether a path status is the one of a file."""
+  return status is not None and status['type'] == 'FILE'
+
+def _pow2_size(name, size):
+  """Round a size up to a power of 2, warning when it changes."""
+  if size is None:
+    return None
+  rounded = _next_pow2(size)
+  if rounded != size:
+    _logger.warning('The %s size must be a power of 2, rounding %s up to %s.', name, size, rounded)
+  return rounded
+
+def _next_pow2(n):
+  """Smallest power of 2 greater than or equal to `n`."""
+  return 1 << (n - 1).bit_length() if n > 1 else 1
 
 if __name__ == '__main__':
   main()
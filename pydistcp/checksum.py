@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Checksums computed on the fly while data is transferred."""
+
+import hashlib
+import logging as lg
+import zlib
+
+try:
+  # Uses the SSE4.2 / ARMv8 CRC32C instructions when available.
+  import google_crc32c
+except ImportError:
+  google_crc32c = None
+
+_logger = lg.getLogger(__name__)
+
+CHECKSUM_ALGORITHMS = ('crc32c', 'md5', 'none')
+
+def _crc32(crc, data):
+  return zlib.crc32(data, crc) & 0xffffffff
+
+if google_crc32c is not None:
+  _CRC_FUNCTIONS = {'crc32c': google_crc32c.extend, 'crc32': _crc32}
+else:
+  _CRC_FUNCTIONS = {'crc32': _crc32}
+
+# Reversed generator polynomials (0x1EDC6F41 and 0x04C11DB7).
+_CRC_POLYNOMIALS = {'crc32c': 0x82F63B78, 'crc32': 0xEDB88320}
+_COMBINE_TABLES = {}
+
+def resolve_algorithm(algorithm):
+  """Return the checksum algorithm to use for a requested one.
+
+  :param algorithm: One of `CHECKSUM_ALGORITHMS`.
+
+  `crc32c` falls back to `crc32` when `google-crc32c` is not installed.
+
+  """
+  if algorithm not in CHECKSUM_ALGORITHMS:
+    raise ValueError('Unsupported checksum algorithm: %r.' % (algorithm,))
+  if algorithm == 'crc32c' and algorithm not in _CRC_FUNCTIONS:
+    _logger.warning('google-crc32c is not installed, using crc32 checksums instead.')
+    return 'crc32'
+  return algorithm
+
+class StreamChecksum(object):
+
+  """Checksum of a stream of chunks, updated as the chunks go through.
+
+  :param algorithm: Checksum algorithm, `crc32c`, `crc32` or `md5`.
+
+  CRC checksums of streams transferred in parallel can be concatenated with
+  :meth:`concat`, without going through the data again.
+
+  """
+
+  def __init__(self, algorithm):
+    self.algorithm = algorithm
+    self.length = 0
+    self._crc = _CRC_FUNCTIONS.get(algorithm)
+    if self._crc is not None:
+      self._value = 0
+    else:
+      self._md5 = hashlib.md5()
+
+  @classmethod
+  def concat(cls, checksums):
+    """Checksum of the concatenation of the streams of CRC checksums.
+
+    :param checksums: List of :class:`StreamChecksum` using the same CRC
+      algorithm, in stream order.
+
+    """
+    algorithm = checksums[0].algorithm
+    if algorithm not in _CRC_POLYNOMIALS:
+      raise ValueError('Checksums of algorithm %r can not be combined.' % (algorithm,))
+    combined = cls(algorithm)
+    for checksum in checksums:
+      combined._value = crc_combine(algorithm, combined._value, checksum.value(), checksum.length)
+      combined.length += checksum.length
+    return combined
+
+  def __repr__(self):
+    return '<%s(%s=%s)>' % (self.__class__.__name__, self.algorithm, self.hexdigest())
+
+  def update(self, data):
+    """Add a chunk of data to the checksum."""
+    self.length += len(data)
+    if self._crc is None:
+      self._md5.update(data)
+    else:
+      self._value = self._crc(self._value, data)
+
+  def track(self, reader):
+    """Wrap a chunk generator, adding every chunk it yields to the checksum."""
+    for chunk in reader:
+      self.update(chunk)
+      yield chunk
+
+  def value(self):
+    """CRC of the whole stream."""
+    return self._value
+
+  def hexdigest(self):
+    if self._crc is None:
+      return self._md5.hexdigest()
+    return '%08x' % (self._value,)
+
+def matches_file_checksum(file_checksum, checksum):
+  """Compare a stream checksum with a file checksum reported by HDFS.
+
+  :param file_checksum: Result of a `GETFILECHECKSUM` request.
+  :param checksum: :class:`StreamChecksum` of the file content.
+
+  Only composite CRC file checksums can be compared with a stream checksum,
+  `None` is returned for any other kind.
+
+  """
+  if file_checksum['algorithm'] != 'COMPOSITE-%s' % (checksum.algorithm.upper(),):
+    return None
+  return file_checksum['bytes'].lower() == checksum.hexdigest()
+
+def crc_combine(algorithm, crc_a, crc_b, length_b):
+  """CRC of the concatenation of two streams from the CRC of each stream.
+
+  :param algorithm: `crc32c` or `crc32`.
+  :param crc_a: CRC of the first stream.
+  :param crc_b: CRC of the second stream.
+  :param length_b: Length in bytes of the second stream.
+
+  This is zlib's `crc32_combine`: `crc_a` is shifted by `length_b` zero bytes
+  using precomputed GF(2) operator matrices for every power of 2 bytes, so
+  the cost is logarithmic in the stream length.
+
+  """
+  table = _COMBINE_TABLES.get(algorithm)
+  if table is None:
+    table = _COMBINE_TABLES[algorithm] = _combine_table(_CRC_POLYNOMIALS[algorithm])
+  power = 0
+  while length_b:
+    if length_b & 1:
+      crc_a = _gf2_times(table[power], crc_a)
+    length_b >>= 1
+    power += 1
+  return crc_a ^ crc_b
+
+def _combine_table(polynomial):
+  """Operators appending 2 ** n zero bytes to a CRC, for n in 0..63."""
+  # Operator for a single zero bit, squared three times for a zero byte.
+  operator = [polynomial] + [1 << n for n in range(31)]
+  for _ in range(3):
+    operator = _gf2_square(operator)
+  table = [operator]
+  for _ in range(63):
+    table.append(_gf2_square(table[-1]))
+  return table
+
+def _gf2_times(matrix, vector):
+  total = 0
+  row = 0
+  while vector:
+    if vector & 1:
+      total ^= matrix[row]
+    vector >>= 1
+    row += 1
+  return total
+
+def _gf2_square(matrix):
+  return [_gf2_times(matrix, matrix[n]) for n in range(32)]
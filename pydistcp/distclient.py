@@ -1,22 +1,61 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import gc
 import time
 import os
 import sys
+import struct
 import glob
 import re
 import logging as lg
 import os.path as osp
+import requests as rq
 from pywhdfs.client import WebHDFSClient
 from pywhdfs.utils import hglob
 from pywhdfs.utils.utils import HdfsError
+from .checksum import StreamChecksum, matches_file_checksum, resolve_algorithm
 from multiprocessing.pool import ThreadPool
 from threading import Lock
+from weakref import WeakSet
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from datetime import datetime
 
+try:
+  import fcntl
+except ImportError: # windows
+  fcntl = None
+
 _logger = lg.getLogger(__name__)
 
+# Upper bound on the worker pool when one thread per file is requested, and
+# maximum number of copies handed to a worker in a single submission.
+MAX_THREADS = 32
+BATCH_SIZE = 32
+
+# fcntl command and flags preallocating a file on macOS (sys/fcntl.h).
+_F_PREALLOCATE = 42
+_F_ALLOCATECONTIG = 0x2
+_F_ALLOCATEALL = 0x4
+_F_PEOFPOSMODE = 3
+
+# Ways of checking a copied file against its source.
+VERIFY_METHODS = ('server', 'stream', 'none')
+
+# Number of directories listed concurrently, bounding the load of a walk on
+# the namenode.
+LIST_THREADS = 16
+
+# Number of copying threads from which the garbage collector is paused.
+_GC_PAUSE_THREADS = 8
+
+# Clients of servers which do not support `LISTSTATUS_BATCH`.
+_NO_LISTSTATUS_BATCH = WeakSet()
+
+# Clients of servers whose file checksums are not composite CRCs.
+_NO_COMPOSITE_CRC = WeakSet()
+
 class WebHDFSDistClient(object):
 
   """HDFS web client using Hadoop token delegation security.
@@ -35,8 +74,69 @@ class WebHDFSDistClient(object):
   def __repr__(self):
     return '<%s(urls=%r),%s(urls=%r)>' % (self.src.__class__.__name__, self.src.host_list, self.dst.__class__.__name__, self.dst.host_list)
 
+  def _preserve(self, src_path, dst_path):
+    """Set the source path attributes on the destination path."""
+    srcstats = self.src.status(src_path)
+    _logger.debug("Preserving %r source attributes on %r" % (src_path,dst_path))
+    self.dst.set_owner(dst_path, owner=srcstats['owner'], group=srcstats['group'])
+    self.dst.set_permission(dst_path, permission=srcstats['permission'])
+    self.dst.set_times(dst_path, access_time=srcstats['accessTime'], modification_time=srcstats['modificationTime'])
+    if srcstats['type'] == 'FILE':
+      self.dst.set_replication(dst_path, replication=int(srcstats['replication']))
+
+  def _matches_checksum(self, dst_path, checksum):
+    """Compare the checksum of copied data with the one of its copy.
+
+    :param dst_path: HDFS path of the copy.
+    :param checksum: :class:`StreamChecksum` of the data sent to the copy.
+
+    Returns `None` when the checksums can not be compared. Destinations which
+    do not report composite CRCs are not asked again for the checksum of
+    later copies.
+
+    """
+    if checksum.algorithm == 'md5' or self.dst in _NO_COMPOSITE_CRC:
+      return None
+    file_checksum = self.dst.checksum(dst_path)
+    if not file_checksum['algorithm'].startswith('COMPOSITE-'):
+      _logger.debug('Destination reports %s checksums, not checking copies.',
+        file_checksum['algorithm'])
+      _NO_COMPOSITE_CRC.add(self.dst)
+      return None
+    return matches_file_checksum(file_checksum, checksum)
+
+  def _verify(self, src_path, dst_path, checksum, method, chunk_size=2 ** 16, buffer_size=None):
+    """Check that a copied file has the same content as its source.
+
+    :param src_path: Source HDFS path.
+    :param dst_path: HDFS path of the copy.
+    :param checksum: :class:`StreamChecksum` of the data sent to the copy.
+    :param method: `server` compares the file checksums computed by the
+      datanodes of both clusters, without transferring any data. Checksums of
+      files stored with different block or checksum chunk sizes differ
+      whatever their content, in which case this falls back to `stream`,
+      which reads the copy back and compares its checksum with `checksum`.
+    :param chunk_size: Interval in bytes by which the copy is read back.
+    :param buffer_size: Buffer size in bytes used for hdfs read operations.
+
+    """
+    if method == 'server':
+      src_checksum = self.src.checksum(src_path)
+      dst_checksum = self.dst.checksum(dst_path)
+      if src_checksum['algorithm'] == dst_checksum['algorithm']:
+        return src_checksum['bytes'] == dst_checksum['bytes']
+      _logger.info('Checksums of %r (%s) and %r (%s) can not be compared, reading the copy back.',
+        src_path, src_checksum['algorithm'], dst_path, dst_checksum['algorithm'])
+    copied = StreamChecksum(checksum.algorithm)
+    with self.dst.read(dst_path, chunk_size=chunk_size, buffer_size=buffer_size) as reader:
+      for _ in copied.track(reader):
+        pass
+    _logger.debug('Copy %r has checksum %r.', dst_path, copied)
+    return copied.hexdigest() == checksum.hexdigest()
+
   def copy(self, src_path, dst_path, overwrite=False, n_threads=1, preserve=False,
-    chunk_size=2 ** 16, buffer_size=2 ** 16, checksum=True, progress=None, **kwargs):
+    chunk_size=2 ** 16, buffer_size=2 ** 16, checksum=True, checksum_algo='crc32c',
+    verify='none', progress=None, **kwargs):
     """Copy a file or directory to HDFS.
 
     :param dst_path: Target HDFS path. If it already exists and is a
@@ -47,8 +147,15 @@ class WebHDFSDistClient(object):
       as a root path.
     :param overwrite: Overwrite any existing file or directory.
     :param n_threads: Number of threads to use for parallelization. A value of
-      `0` (or negative) uses as many threads as there are files.
+      `0` (or negative) uses as many threads as there are files, up to
+      `MAX_THREADS`.
     :param chunk_size: Interval in bytes by which the files will be copied.
+    :param checksum_algo: Checksum computed on the copied data while it is
+      transferred, one of `crc32c`, `md5` or `none`. Files whose destination
+      reports a different composite CRC are removed and reported as failed.
+    :param verify: Check every copied file against its source, see
+      :meth:`_verify`. Files failing the check are removed and reported as
+      failed.
     :param progress: Callback function to track progress, called every
       `chunk_size` bytes. It will be passed two arguments, the path to the
       file being copied and the number of bytes transferred so far. On
@@ -61,36 +168,26 @@ class WebHDFSDistClient(object):
     start_time = time.time()
     if not chunk_size:
       raise ValueError('Copy chunk size must be positive.')
+    checksum_algo = _verified_algorithm(resolve_algorithm(checksum_algo), verify)
 
     lock = Lock()
     stat_lock = Lock()
 
     _logger.info('Copying %r to %r.', src_path, dst_path)
 
-    def _preserve(_src_path, _dst_path):
-      # set the base path attributes
-
-      srcstats = self.src.status(_src_path)
-      _logger.debug("Preserving %r source attributes on %r" % (_src_path,_dst_path))
-      self.dst.set_owner(_dst_path, owner=srcstats['owner'], group=srcstats['group'])
-      self.dst.set_permission(_dst_path, permission=srcstats['permission'])
-      self.dst.set_times(_dst_path, access_time=srcstats['accessTime'], modification_time=srcstats['modificationTime'])
-      if srcstats['type'] == 'FILE':
-        self.dst.set_replication(_dst_path, replication=int(srcstats['replication']))
-
     def _copy_wrap(_path_tuple):
-      _src_path, _dst_path = _path_tuple
+      _src_path, _dst_path, _size = _path_tuple
       try:
         status = _copy(_path_tuple)
         return status
       except Exception as exp:
         _logger.exception('Error while copying %r to %r. %s' % (_src_path,_dst_path,exp))
-        return { 'status': 'failed', 'src_path': _src_path, 'dest_path' : _dst_path }
+        return ('failed', _size)
 
     def _copy(_path_tuple):
       """Copy a single file."""
 
-      _src_path, _dst_path = _path_tuple
+      _src_path, _dst_path, _size = _path_tuple
       _tmp_path = ""
 
       skip=False
@@ -139,7 +236,7 @@ class WebHDFSDistClient(object):
                 self.dst.makedirs(curpath)
                 if preserve:
                   curr_src_path=osp.realpath( osp.join( _src_path,osp.relpath(curpath,_tmp_path)) )
-                  _preserve(curr_src_path,curpath)
+                  self._preserve(curr_src_path,curpath)
 
         _logger.info('Copying %r to %r.', _src_path, _tmp_path)
 
@@ -148,9 +245,24 @@ class WebHDFSDistClient(object):
           kwargs['replication'] = int(srcstats['replication'])
           kwargs['blocksize'] = int(srcstats['blockSize'])
 
+        _checksum = None
         with self.src.read(_src_path, chunk_size=chunk_size, progress=progress, buffer_size=buffer_size) as _reader:
+          if checksum_algo != 'none':
+            _checksum = StreamChecksum(checksum_algo)
+            _reader = _checksum.track(_reader)
           self.dst.write(_tmp_path, _reader, buffersize=buffer_size, **kwargs)
 
+        if _checksum:
+          _logger.debug('Copied data of %r has checksum %r.', _src_path, _checksum)
+          if self._matches_checksum(_tmp_path, _checksum) is False:
+            self.dst.delete(_tmp_path)
+            raise HdfsError('Checksum of %r does not match the copied data.', _dst_path)
+
+        if verify != 'none' and not self._verify(_src_path, _tmp_path, _checksum, verify,
+          chunk_size=chunk_size, buffer_size=buffer_size):
+          self.dst.delete(_tmp_path)
+          raise HdfsError('Copy of %r does not match its source.', _src_path)
+
         if _tmp_path != _dst_path:
           _logger.info( 'Copy of %r complete. Moving from %r to %r.', _src_path, _tmp_path, _dst_path )
           self.dst.delete(_dst_path)
@@ -159,18 +271,16 @@ class WebHDFSDistClient(object):
           _logger.info(
             'Copy of %r to %r complete.', _src_path, _dst_path
           )
-
         if preserve:
-          _preserve(_src_path,_dst_path)
+          self._preserve(_src_path,_dst_path)
 
-        return { 'status': 'copied', 'src_path': _src_path, 'dest_path' : _dst_path }
+        return ('copied', _size)
       else:
         # file was skipped
         if progress:
-          src_st=self.src.status(_src_path,strict=False)
-          progress(_src_path, int(src_st['length']))
+          progress(_src_path, _size)
           progress(_src_path, -1)
-        return { 'status': 'skipped', 'src_path': _src_path, 'dest_path' : _dst_path }
+        return ('skipped', _size)
 
     # Normalise src and dst paths
     src_path = self.src.resolvepath(src_path)
@@ -245,25 +355,22 @@ class WebHDFSDistClient(object):
     fpath_tuples = []
     for copy_tuple in tuples:
       # Then we figure out which files we need to copy, and where.
-      src_paths = list(self.src.walk(copy_tuple['src_path']))
-      if not src_paths:
+      src_st = self.src.status(copy_tuple['src_path'])
+      if src_st['type'] == 'FILE':
         # This is a single file.
-        src_fpaths = [copy_tuple['src_path']]
+        src_fpaths = [(copy_tuple['src_path'], int(src_st['length']))]
       else:
-        src_fpaths = [
-          osp.join(dpath, fname)
-          for dpath, _, fnames in src_paths
-          for fname in fnames
-        ]
+        src_fpaths = walk_files(self.src, copy_tuple['src_path'], n_threads=n_threads)
 
       offset = len(copy_tuple['src_path'].rstrip(os.sep)) + len(os.sep)
 
       fpath_tuples.extend([
           (
             fpath,
-            osp.join(copy_tuple['dst_path'], fpath[offset:].replace(os.sep, '/')).rstrip(os.sep)
+            osp.join(copy_tuple['dst_path'], fpath[offset:].replace(os.sep, '/')).rstrip(os.sep),
+            size
           )
-          for fpath in src_fpaths
+          for fpath, size in src_fpaths
       ])
 
     _logger.info("--- scan finished in %s seconds, copying %s files ---" % (time.time() - start_time, len(fpath_tuples)))
@@ -271,28 +378,11 @@ class WebHDFSDistClient(object):
     if len(fpath_tuples) == 0:
       end_time = time.time()
       _logger.warn("could not find any file to copy.")
-      return {
-        'Source Path'      : src_path,
-        'Destination Path' : dst_path,
-        'Start Time'       : datetime.fromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S'),
-        'End Time'         : datetime.fromtimestamp(end_time).strftime('%Y-%m-%d %H:%M:%S'),
-        'Duration'         : end_time - start_time,
-        'Outcome'          : 'Successful',
-        'Files Expected'   : 0,
-        'Size Expected'    : 0,
-        'Files Copied'     : 0,
-        'Size Copied'      : 0,
-        'Files Failed'     : 0,
-        'Size Failed'      : 0,
-        'Files Deleted'    : 0,
-        'Size Deleted'     : 0,
-        'Files Skipped'    : 0,
-        'Size Skipped'     : 0,
-      }
+      return _job_status(src_path, dst_path, start_time, end_time)
 
     # Finally, we copy all files (optionally, in parallel).
     if n_threads <= 0:
-      n_threads = len(fpath_tuples)
+      n_threads = min(MAX_THREADS, len(fpath_tuples))
     else:
       n_threads = min(n_threads, len(fpath_tuples))
     _logger.debug(
@@ -300,12 +390,13 @@ class WebHDFSDistClient(object):
     )
 
     try:
-      if n_threads == 1:
-        results = []
-        for path_tuple in fpath_tuples:
-          results.append( _copy_wrap(path_tuple) )
-      else:
-        results = _map_async(n_threads, _copy_wrap, fpath_tuples)
+      with _paused_gc(n_threads):
+        if n_threads == 1:
+          results = []
+          for path_tuple in fpath_tuples:
+            results.append( _copy_wrap(path_tuple) )
+        else:
+          results = _map_async(n_threads, _copy_wrap, fpath_tuples)
     except Exception as err: # pylint: disable=broad-except
       _logger.exception('Error while copying.')
       raise err
@@ -313,59 +404,559 @@ class WebHDFSDistClient(object):
     end_time = time.time()
 
     # Transfer summary
-    status = {
-      'Source Path'      : src_path,
-      'Destination Path' : dst_path,
-      'Start Time'       : datetime.fromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S'),
-      'End Time'         : datetime.fromtimestamp(end_time).strftime('%Y-%m-%d %H:%M:%S'),
-      'Duration'         : end_time - start_time,
-      'Outcome'          : 'Successful',
-      'Files Expected'   : 0,
-      'Size Expected'    : 0,
-      'Files Copied'     : 0,
-      'Size Copied'      : 0,
-      'Files Failed'     : 0,
-      'Size Failed'      : 0,
-      'Files Deleted'    : 0,
-      'Size Deleted'     : 0,
-      'Files Skipped'    : 0,
-      'Size Skipped'     : 0,
-      'Already Exists': 0,
-    }
-
-    for result in results:
-      try:
-          file_st = self.src.status(result['src_path'],strict=True)
-          status['Files Expected']+=1
-          status['Size Expected']+=int(file_st['length'])
-          if result['status'] == 'copied':
-            status['Files Copied']+=1
-            status['Size Copied']+=int(file_st['length'])
-          if result['status'] == 'skipped':
-            status['Files Skipped']+=1
-            status['Size Skipped']+=int(file_st['length'])
-          if result['status'] == 'failed':
-            status['Files Failed']+=1
-            status['Size Failed']+=int(file_st['length'])
-            status['Outcome'] = 'Failed'
-
-      except:
-          pass
+    status = _job_status(src_path, dst_path, start_time, end_time)
+    status['Already Exists'] = 0
+
+    # Already existing destinations have no result, they are counted by the
+    # skipper.
+    _tally(status, results)
+    status['Already Exists'] = self.skipper
+    return status
+
+  def copy_ranged(self, src_path, dst_path, n_streams, overwrite=False, preserve=False,
+    chunk_size=2 ** 16, buffer_size=2 ** 16, checksum=True, checksum_algo='crc32c',
+    verify='none', progress=None, **kwargs):
+    """Copy a single large file using several parallel streams.
+
+    The file is split into `n_streams` block aligned segments which are read
+    with ranged `OPEN` requests and written concurrently to temporary parts
+    next to the destination, then stitched together with `CONCAT`.
+
+    :param src_path: Source HDFS path, must be a file.
+    :param dst_path: Target HDFS path. If it already exists and is a
+      directory, the file will be copied inside.
+    :param n_streams: Number of segments to transfer in parallel.
+    :param overwrite: Overwrite any existing file.
+    :param preserve: Preserve file attributes.
+    :param chunk_size: Interval in bytes by which the segments will be copied.
+    :param buffer_size: Buffer size in bytes used for hdfs read and write
+      operations.
+    :param checksum: Skip the copy when an existing destination file has the
+      same checksum as the source.
+    :param checksum_algo: Checksum computed on the copied data while it is
+      transferred, `crc32c` or `none`. Each stream checksums its own segment
+      and the results are combined, the copy fails if the destination
+      reports a different composite CRC.
+    :param verify: Check the copied file against its source, see
+      :meth:`_verify`.
+    :param progress: Callback function to track progress, see :meth:`copy`.
+    :param \*\*kwargs: Keyword arguments forwarded to :meth:`write`.
+
+    This method returns the same job status as :meth:`copy`.
+
+    """
+    start_time = time.time()
+    if not chunk_size:
+      raise ValueError('Copy chunk size must be positive.')
+    checksum_algo = resolve_algorithm(checksum_algo)
+    if checksum_algo == 'md5':
+      _logger.info('md5 checksums can not be combined across streams, not computing them.')
+      checksum_algo = 'none'
+    checksum_algo = _verified_algorithm(checksum_algo, verify)
+
+    src_path = self.src.resolvepath(src_path)
+    dst_path = self.dst.resolvepath(dst_path)
+    src_st = self.src.status(src_path)
+    if src_st['type'] != 'FILE':
+      raise HdfsError('Ranged copy requires a file, %r is a directory.', src_path)
+    length = int(src_st['length'])
+    blocksize = int(src_st['blockSize'])
+
+    dst_st = self.dst.status(dst_path, strict=False)
+    if dst_st is not None and dst_st['type'] == 'DIRECTORY':
+      dst_path = osp.join(dst_path, osp.basename(src_path))
+      dst_st = self.dst.status(dst_path, strict=False)
+    elif dst_st is None and self.dst.status(osp.dirname(dst_path), strict=False) is None:
+      raise HdfsError('Parent directory of %r does not exist.', dst_path)
+
+    status = _job_status(src_path, dst_path, start_time, start_time)
+    status['Already Exists'] = self.skipper
+    if dst_st is not None and not overwrite:
+      # Counted by the skipper like the files of :meth:`copy`.
+      _logger.info('Destination %r already exists, skipping.', dst_path)
+      self.skipper += 1
       status['Already Exists'] = self.skipper
+      status['End Time'], status['Duration'] = _end_time(start_time)
+      return status
+    status['Files Expected'] = 1
+    status['Size Expected'] = length
+
+    skip = False
+    if dst_st is not None and checksum:
+      src_checksum = self.src.checksum(src_path)
+      dst_checksum = self.dst.checksum(dst_path)
+      if src_checksum == dst_checksum:
+        _logger.info('source %r and destination %r seems to be identical, skipping.', src_path, dst_path)
+        skip = True
+
+    if skip:
+      if progress:
+        progress(src_path, length)
+        progress(src_path, -1)
+      status['Files Skipped'] = 1
+      status['Size Skipped'] = length
+      status['End Time'], status['Duration'] = _end_time(start_time)
+      return status
+
+    # Segments must start on block boundaries for the parts to be concatenated.
+    segment_size = max(-(-length // (n_streams * blocksize)), 1) * blocksize
+    segments = [
+      (offset, min(segment_size, length - offset))
+      for offset in range(0, length, segment_size)
+    ]
+    tmp_path = '%s.temp-%s' % (dst_path, int(time.time()))
+    parts = ['%s.part-%05d' % (tmp_path, index) for index in range(len(segments))]
+    tracker = _SegmentProgress(src_path, progress)
+    reader = _DatanodeReader(self.src, src_path, blocksize)
+    checksums = [
+      StreamChecksum(checksum_algo) if checksum_algo != 'none' else None
+      for _ in segments
+    ]
+
+    _logger.info('Copying %r to %r using %s streams.', src_path, dst_path, len(segments))
+
+    def _copy_segment(_index):
+      _offset, _length = segments[_index]
+      with reader.read(_offset, _length, chunk_size=chunk_size,
+        buffer_size=buffer_size) as _reader:
+        _reader = tracker.track(_reader)
+        if checksums[_index]:
+          _reader = checksums[_index].track(_reader)
+        self.dst.write(parts[_index], _reader, blocksize=blocksize,
+          buffersize=buffer_size, **kwargs)
+
+    try:
+      _map_async(len(segments), _copy_segment, list(range(len(segments))))
+      if len(parts) > 1:
+        self.dst._api_request(method='POST', hdfs_path=parts[0],
+          params={'op': 'CONCAT', 'sources': ','.join(parts[1:])})
+      if checksum_algo != 'none':
+        _checksum = StreamChecksum.concat(checksums)
+        _logger.debug('Copied data of %r has checksum %r.', src_path, _checksum)
+        if self._matches_checksum(parts[0], _checksum) is False:
+          raise HdfsError('Checksum of %r does not match the copied data.', dst_path)
+        if verify != 'none' and not self._verify(src_path, parts[0], _checksum, verify,
+          chunk_size=chunk_size, buffer_size=buffer_size):
+          raise HdfsError('Copy of %r does not match its source.', src_path)
+      if dst_st is not None:
+        self.dst.delete(dst_path)
+      self.dst.rename(parts[0], dst_path)
+      if preserve:
+        self._preserve(src_path, dst_path)
+    except Exception as err: # pylint: disable=broad-except
+      _logger.exception('Error while copying %r to %r. %s' % (src_path, dst_path, err))
+      for part in parts:
+        try:
+          self.dst.delete(part)
+        except HdfsError:
+          _logger.error('Unable to cleanup temporary part %r.', part)
+      status['Files Failed'] = 1
+      status['Size Failed'] = length
+      status['Outcome'] = 'Failed'
+    else:
+      status['Files Copied'] = 1
+      status['Size Copied'] = length
+    finally:
+      tracker.done()
+
+    status['End Time'], status['Duration'] = _end_time(start_time)
     return status
 
+def download_ranged(client, hdfs_path, local_path, n_streams, overwrite=False,
+  chunk_size=2 ** 16, buffer_size=None, progress=None):
+  """Download a single large file using several parallel streams.
+
+  The local file is allocated up front (see :func:`_preallocate`) and each
+  stream writes its own segment in place with `os.pwrite`, so no locking is
+  needed between them.
+
+  :param client: HDFS client.
+  :param hdfs_path: HDFS path of the file to download.
+  :param local_path: Local path. If it already exists and is a directory,
+    the file will be downloaded inside of it.
+  :param n_streams: Number of segments to transfer in parallel.
+  :param overwrite: Overwrite any existing file.
+  :param chunk_size: Interval in bytes by which the segments will be written.
+  :param buffer_size: Buffer size in bytes used for hdfs read operations.
+  :param progress: Callback function to track progress, see
+    :meth:`WebHDFSDistClient.copy`.
+
+  On success, this method returns the local download path.
+
+  """
+  start_time = time.time()
+  hdfs_path = client.resolvepath(hdfs_path)
+  local_path = osp.realpath(osp.normpath(local_path))
+  src_status = client.status(hdfs_path)
+  length = int(src_status['length'])
+
+  if osp.isdir(local_path):
+    local_path = osp.join(local_path, osp.basename(hdfs_path))
+  if osp.exists(local_path):
+    if not overwrite:
+      raise HdfsError('Path %r already exists.', local_path)
+    temp_path = '%s.temp-%s' % (local_path, int(time.time()))
+  elif not osp.exists(osp.dirname(local_path)):
+    raise HdfsError('Parent directory of %r does not exist.', local_path)
+  else:
+    temp_path = local_path
+
+  segment_size = max(-(-length // n_streams), 1)
+  segments = [
+    (offset, min(segment_size, length - offset))
+    for offset in range(0, length, segment_size)
+  ]
+  tracker = _SegmentProgress(hdfs_path, progress)
+  reader = _DatanodeReader(client, hdfs_path, int(src_status['blockSize']))
+
+  _logger.info('Downloading %r to %r using %s streams.', hdfs_path, local_path, len(segments))
+
+  def _download_segment(_segment):
+    segment_offset, _length = _segment
+    _offset = segment_offset
+    with reader.read(_offset, _length, chunk_size=chunk_size,
+      buffer_size=buffer_size) as _reader:
+      for chunk in tracker.track(_reader):
+        os.pwrite(fd, chunk, _offset)
+        _offset += len(chunk)
+    # The file is allocated to its full size, a short read would leave a gap.
+    if _offset != segment_offset + _length:
+      raise HdfsError('Read %s bytes of %r at offset %s, expected %s.',
+        _offset - segment_offset, hdfs_path, segment_offset, _length)
+
+  fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  try:
+    _preallocate(fd, length)
+    _map_async(max(len(segments), 1), _download_segment, segments)
+  except Exception as err: # pylint: disable=broad-except
+    _logger.exception('Error while downloading. Attempting cleanup.')
+    os.close(fd)
+    os.remove(temp_path)
+    raise err
+  else:
+    os.close(fd)
+  finally:
+    tracker.done()
+
+  if temp_path != local_path:
+    _logger.debug('Download of %r complete. Moving from %r to %r.', hdfs_path, temp_path, local_path)
+    os.remove(local_path)
+    os.rename(temp_path, local_path)
+
+  _logger.debug("--- download finished in : %s seconds ---" % (time.time() - start_time))
+  return local_path
+
+def list_status_batch(client, hdfs_path):
+  """Statuses of the entries of an HDFS directory.
+
+  :param client: HDFS client.
+  :param hdfs_path: HDFS path of a directory.
+
+  The directory is listed a page at a time with `LISTSTATUS_BATCH`, entries
+  being yielded as the pages arrive, so that large directories are not sent
+  back as a single huge response. Servers which do not
+  support it (HttpFS, Hadoop before 2.8) are listed with a single
+  `LISTSTATUS`.
+
+  """
+  if client not in _NO_LISTSTATUS_BATCH:
+    params = {'op': 'LISTSTATUS_BATCH'}
+    while True:
+      try:
+        listing = client._api_request(method='GET', hdfs_path=hdfs_path,
+          params=params).json()['DirectoryListing']
+      except HdfsError as err:
+        # Servers without batched listings reject the operation itself.
+        if 'startAfter' in params or 'LISTSTATUS_BATCH' not in str(err):
+          raise
+        _logger.debug('Batched listing of %r failed, listing it at once.', hdfs_path)
+        _NO_LISTSTATUS_BATCH.add(client)
+        break
+      statuses = listing['partialListing']['FileStatuses']['FileStatus']
+      for file_status in statuses:
+        yield file_status
+      if not statuses or not listing['remainingEntries']:
+        return
+      params = {'op': 'LISTSTATUS_BATCH', 'startAfter': statuses[-1]['pathSuffix']}
+  res = client._api_request(method='GET', hdfs_path=hdfs_path, params={'op': 'LISTSTATUS'})
+  for file_status in res.json()['FileStatuses']['FileStatus']:
+    yield file_status
+
+def walk_files(client, hdfs_path, n_threads=LIST_THREADS):
+  """List all files under an HDFS directory.
+
+  :param client: HDFS client.
+  :param hdfs_path: HDFS path of a directory.
+  :param n_threads: Number of threads the client connection pool is sized
+    for. A value of `0` (or negative) uses `LIST_THREADS`.
+
+  The tree is walked breadth first, the directories of each level being
+  listed concurrently by up to `n_threads` threads, and never more than
+  `LIST_THREADS`. This method returns a list of `(path, length)` tuples.
+
+  """
+  def _list(dir_path):
+    return [
+      (osp.join(dir_path, file_status['pathSuffix']), file_status)
+      for file_status in list_status_batch(client, dir_path)
+    ]
+
+  n_threads = min(n_threads, LIST_THREADS) if n_threads > 0 else LIST_THREADS
+  files = []
+  level = [hdfs_path]
+  while level:
+    if len(level) == 1 or n_threads == 1:
+      listings = [_list(dir_path) for dir_path in level]
+    else:
+      listings = _map_async(min(n_threads, len(level)), _list, level)
+    level = []
+    for listing in listings:
+      for path, file_status in listing:
+        if file_status['type'] == 'DIRECTORY':
+          level.append(path)
+        else:
+          files.append((path, int(file_status['length'])))
+  return files
+
+class _SegmentProgress(object):
+
+  """Aggregate the progress of concurrently transferred segments of a file.
+
+  :param path: Path reported to the progress callback.
+  :param progress: Progress callback, may be `None`.
+
+  """
+
+  def __init__(self, path, progress):
+    self._path = path
+    self._progress = progress
+    self._nbytes = 0
+    self._lock = Lock()
+
+  def track(self, reader):
+    """Wrap a chunk generator, reporting the bytes it yields."""
+    for chunk in reader:
+      if self._progress:
+        with self._lock:
+          self._nbytes += len(chunk)
+          self._progress(self._path, self._nbytes)
+      yield chunk
+
+  def done(self):
+    if self._progress:
+      self._progress(self._path, -1)
+
+class _DatanodeReader(object):
+
+  """Ranged reads of a single HDFS file, sent straight to a datanode.
+
+  :param client: HDFS client.
+  :param hdfs_path: HDFS path of the file to read.
+  :param block_size: Block size of the file.
+
+  Every `OPEN` request is redirected by the namenode to a datanode holding
+  the block at the requested offset. The location of each block is kept and
+  later reads starting in the same block only rewrite its range, saving a
+  round-trip to the namenode per read. A location is dropped when its
+  datanode stops answering for the file (e.g. connection refused, or 404 or
+  410 after a restart), and the next read of the block is redirected again.
+
+  """
+
+  def __init__(self, client, hdfs_path, block_size):
+    self._client = client
+    self._path = hdfs_path
+    self._block_size = block_size
+    self._locations = {}
+    self._lock = Lock()
+
+  def _datanode_url(self, block):
+    """Location of the datanode serving a block of the file, `None` when the
+    server does not redirect reads (e.g. HttpFS)."""
+    with self._lock:
+      location = self._locations.get(block)
+    if location is None:
+      res = self._client._api_request(method='GET', hdfs_path=self._path,
+        params={'op': 'OPEN', 'offset': block * self._block_size, 'length': 0},
+        allow_redirects=False, stream=True)
+      res.close()
+      location = res.headers.get('location', '')
+      _logger.debug('Block %s of %r is served by %r.', block, self._path, location)
+      with self._lock:
+        self._locations[block] = location
+    return location or None
+
+  def _invalidate(self, block, location):
+    with self._lock:
+      if self._locations.get(block) == location:
+        del self._locations[block]
+
+  @contextmanager
+  def read(self, offset, length, chunk_size, buffer_size=None):
+    """Read a range of the file, see :meth:`WebHDFSClient.read`."""
+    block = offset // self._block_size
+    location = self._datanode_url(block)
+    res = None
+    if location:
+      url = urlsplit(location)
+      params = dict(parse_qsl(url.query))
+      params.update({'offset': offset, 'length': length})
+      if buffer_size:
+        params['buffersize'] = buffer_size
+      url = urlunsplit(url._replace(query=urlencode(params)))
+      try:
+        res = self._client._request(method='GET', url=url, strict=False, stream=True)
+      except rq.ConnectionError as err:
+        _logger.info('Datanode %r failed reading %r (%s), redirecting again.',
+          location, self._path, err)
+        self._invalidate(block, location)
+      else:
+        if not res:
+          _logger.info('Datanode %r failed reading %r (status %s), redirecting again.',
+            location, self._path, res.status_code)
+          res.close()
+          res = None
+          self._invalidate(block, location)
+    if res is None:
+      with self._client.read(self._path, offset=offset, length=length,
+        chunk_size=chunk_size, buffer_size=buffer_size) as reader:
+        yield reader
+      return
+    try:
+      yield res.iter_content(chunk_size=chunk_size)
+    finally:
+      res.close()
+
 # Helpers
 # -------
 
+def _job_status(src_path, dst_path, start_time, end_time):
+  """Empty transfer summary."""
+  return {
+    'Source Path'      : src_path,
+    'Destination Path' : dst_path,
+    'Start Time'       : datetime.fromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S'),
+    'End Time'         : datetime.fromtimestamp(end_time).strftime('%Y-%m-%d %H:%M:%S'),
+    'Duration'         : end_time - start_time,
+    'Outcome'          : 'Successful',
+    'Files Expected'   : 0,
+    'Size Expected'    : 0,
+    'Files Copied'     : 0,
+    'Size Copied'      : 0,
+    'Files Failed'     : 0,
+    'Size Failed'      : 0,
+    'Files Deleted'    : 0,
+    'Size Deleted'     : 0,
+    'Files Skipped'    : 0,
+    'Size Skipped'     : 0,
+  }
+
+def _verified_algorithm(checksum_algo, verify):
+  """Checksum algorithm to compute on the copied data when verifying it."""
+  if verify not in VERIFY_METHODS:
+    raise ValueError('Unsupported verification method: %r.' % (verify,))
+  if verify != 'none' and checksum_algo == 'none':
+    # Verifying on the servers may still need to fall back to reading back.
+    return resolve_algorithm('crc32c')
+  return checksum_algo
+
+def _preallocate(fd, size):
+  """Allocate the blocks of a file before it is written.
+
+  :param fd: File descriptor open for writing.
+  :param size: Final size of the file.
+
+  Allocating the whole file at once lets the filesystem pick contiguous
+  extents, and spares the writes from extending the file one chunk at a time.
+  Filesystems which can not preallocate still get the file extended to its
+  final size, sparse.
+
+  """
+  if not size:
+    return
+  if hasattr(os, 'posix_fallocate'):
+    try:
+      os.posix_fallocate(fd, 0, size)
+      return
+    except OSError as err:
+      _logger.debug('Unable to preallocate file: %s.', err)
+  elif fcntl is not None and sys.platform == 'darwin':
+    # fstore_t, contiguous space first then any space, from the end of file.
+    for flags in (_F_ALLOCATECONTIG | _F_ALLOCATEALL, _F_ALLOCATEALL):
+      try:
+        fcntl.fcntl(fd, _F_PREALLOCATE, struct.pack('Iiqqq', flags, _F_PEOFPOSMODE, 0, size, 0))
+        break
+      except (IOError, OSError) as err:
+        _logger.debug('Unable to preallocate file: %s.', err)
+  os.ftruncate(fd, size)
+
+def _tally(status, results):
+  """Add the results of file copies to a job status.
+
+  :param status: Job status, see :func:`_job_status`.
+  :param results: `(outcome, size)` tuple of every copy, where outcome
+    is one of `copied`, `skipped` or `failed`. `None` results are ignored.
+
+  Workers return tuples rather than dictionaries, so that jobs of many files
+  keep few objects alive until the end of the transfer.
+
+  """
+  counts = dict((outcome, [0, 0]) for outcome in ('copied', 'skipped', 'failed'))
+  for result in results:
+    if result is not None:
+      count = counts[result[0]]
+      count[0] += 1
+      count[1] += result[1]
+  for outcome, (nfiles, nbytes) in counts.items():
+    status['Files Expected'] += nfiles
+    status['Size Expected'] += nbytes
+    status['Files %s' % outcome.capitalize()] += nfiles
+    status['Size %s' % outcome.capitalize()] += nbytes
+  if counts['failed'][0]:
+    status['Outcome'] = 'Failed'
+
+def _end_time(start_time):
+  """Formatted end time and duration of a transfer started at `start_time`."""
+  end_time = time.time()
+  return datetime.fromtimestamp(end_time).strftime('%Y-%m-%d %H:%M:%S'), end_time - start_time
+
+@contextmanager
+def _paused_gc(n_threads):
+  """Disable the garbage collector while `n_threads` threads copy files.
+
+  Transfers allocate few reference cycles, but collections triggered by the
+  many short lived objects of each chunk stop all worker threads. Pending
+  garbage is collected once the copies are over.
+
+  :param n_threads: Number of threads actually copying files.
+  """
+  pause = n_threads >= _GC_PAUSE_THREADS and gc.isenabled()
+  if pause:
+    gc.disable()
+  try:
+    yield
+  finally:
+    if pause:
+      gc.enable()
+      gc.collect()
+
 def _map_async(pool_size, func, args):
   """Async map (threading), handling python 2.6 edge case.
 
+  Arguments are submitted to the pool in batches of up to `BATCH_SIZE` so
+  that many small files do not cost one queue round-trip each.
+
   :param pool_size: Maximum number of threads.
   :param func: Function to run.
-  :param args: Iterable of arguments (one per thread).
+  :param args: List of arguments (one per call).
   """
+  chunksize = max(1, min(BATCH_SIZE, len(args) // (pool_size * 4)))
   pool = ThreadPool(pool_size)
-  if sys.version_info <= (2, 6):
-    return pool.map(func, args)
-  else:
-    return pool.map_async(func, args).get(1 << 31)
+  try:
+    if sys.version_info <= (2, 6):
+      return pool.map(func, args, chunksize)
+    else:
+      return pool.map_async(func, args, chunksize).get(1 << 31)
+  finally:
+    pool.close()
+    pool.join()
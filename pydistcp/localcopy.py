@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import errno
+import glob
+import logging as lg
+import os
+import os.path as osp
+import shutil
+import time
+from pywhdfs.utils.utils import HdfsError
+from threading import Lock
+from .distclient import MAX_THREADS, _end_time, _job_status, _map_async, _paused_gc, _tally
+from .utils import _scan, compile_pattern
+
+_logger = lg.getLogger(__name__)
+
+# Errors meaning that an in-kernel copy is not possible between two files.
+_UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
+
+def copy_local(src_path, dst_path, overwrite=False, n_threads=1, preserve=False,
+  chunk_size=2 ** 22, progress=None, include_pattern="*", min_size=0):
+  """Copy a local file or directory to another local path.
+
+  Data is copied in the kernel with `copy_file_range` (a reflink on
+  filesystems supporting it) or `sendfile`, and only goes through user
+  space when neither is available.
+
+  :param src_path: Local path (or pattern) to file or folder. If a folder,
+    all the files inside of it will be copied.
+  :param dst_path: Target local path. If it already exists and is a
+    directory, files will be copied inside.
+  :param overwrite: Overwrite any existing file.
+  :param n_threads: Number of threads to use for parallelization. A value of
+    `0` (or negative) uses as many threads as there are files, up to
+    `MAX_THREADS`.
+  :param preserve: Preserve file permissions and times.
+  :param chunk_size: Number of bytes copied per system call.
+  :param progress: Callback function to track progress, see
+    :meth:`WebHDFSDistClient.copy`.
+  :param include_pattern: Only copy files whose name matches this pattern,
+    as a string or compiled with :func:`compile_pattern`.
+  :param min_size: Only copy files of at least this size.
+
+  This method returns the same job status as :meth:`WebHDFSDistClient.copy`.
+
+  """
+  start_time = time.time()
+  if not chunk_size:
+    raise ValueError('Copy chunk size must be positive.')
+
+  lock = Lock()
+  dst_path = osp.realpath(osp.normpath(dst_path))
+
+  copies = glob.glob(src_path)
+  if len(copies) == 0:
+    raise HdfsError('Cloud not resolve source path %s, either it does not exist or can not access it.', src_path)
+
+  if osp.isdir(dst_path):
+    bases = [(copy, osp.join(dst_path, osp.basename(copy.rstrip(os.sep)))) for copy in copies]
+  elif osp.isdir(osp.dirname(dst_path)):
+    bases = [(copy, dst_path) for copy in copies]
+  else:
+    raise HdfsError('Parent directory of %r does not exist.', dst_path)
+
+  pattern = compile_pattern(include_pattern)
+  min_size = int(min_size)
+  fpath_tuples = []
+  for src_base, dst_base in bases:
+    if osp.isdir(src_base):
+      for entry in _scan(src_base):
+        if pattern.match(entry.name):
+          size = entry.stat().st_size
+          if size >= min_size:
+            fpath_tuples.append((entry.path, osp.join(dst_base, osp.relpath(entry.path, src_base)), size))
+    else:
+      size = osp.getsize(src_base)
+      if size >= min_size and pattern.match(osp.basename(src_base)):
+        fpath_tuples.append((src_base, dst_base, size))
+
+  def _copy_wrap(_path_tuple):
+    _src_path, _dst_path, _size = _path_tuple
+    try:
+      return _copy(_path_tuple)
+    except Exception as exp:
+      _logger.exception('Error while copying %r to %r. %s' % (_src_path,_dst_path,exp))
+      return ('failed', _size)
+
+  def _copy(_path_tuple):
+    """Copy a single file."""
+    _src_path, _dst_path, _size = _path_tuple
+    if osp.exists(_dst_path):
+      if not overwrite:
+        # Counted as already existing, like the files of copy().
+        _logger.info('Destination %r already exists, skipping.', _dst_path)
+        if progress:
+          progress(_src_path, _size)
+          progress(_src_path, -1)
+        return None
+      _tmp_path = '%s.temp-%s' % (_dst_path, int(time.time()))
+    else:
+      _tmp_path = _dst_path
+      with lock:
+        # Prevent race condition when creating directories
+        if not osp.exists(osp.dirname(_dst_path)):
+          os.makedirs(osp.dirname(_dst_path))
+
+    _logger.info('Copying %r to %r.', _src_path, _tmp_path)
+    src_fd = os.open(_src_path, os.O_RDONLY)
+    try:
+      mode = os.fstat(src_fd).st_mode & 0o777
+      dst_fd = os.open(_tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+      try:
+        _copy_fd(src_fd, dst_fd, chunk_size, _src_path, progress)
+      finally:
+        os.close(dst_fd)
+    finally:
+      os.close(src_fd)
+
+    if preserve:
+      shutil.copystat(_src_path, _tmp_path)
+    if _tmp_path != _dst_path:
+      _logger.info('Copy of %r complete. Moving from %r to %r.', _src_path, _tmp_path, _dst_path)
+      os.replace(_tmp_path, _dst_path)
+    return ('copied', _size)
+
+  if len(fpath_tuples) == 0:
+    _logger.warn("could not find any file to copy.")
+    return _job_status(src_path, dst_path, start_time, time.time())
+
+  if n_threads <= 0:
+    n_threads = min(MAX_THREADS, len(fpath_tuples))
+  else:
+    n_threads = min(n_threads, len(fpath_tuples))
+  _logger.debug('Copying %s files using %s thread(s).', len(fpath_tuples), n_threads)
+
+  with _paused_gc(n_threads):
+    if n_threads == 1:
+      results = [_copy_wrap(path_tuple) for path_tuple in fpath_tuples]
+    else:
+      results = _map_async(n_threads, _copy_wrap, fpath_tuples)
+
+  status = _job_status(src_path, dst_path, start_time, start_time)
+  _tally(status, results)
+  status['Already Exists'] = results.count(None)
+  status['End Time'], status['Duration'] = _end_time(start_time)
+  return status
+
+def _copy_fd(src_fd, dst_fd, chunk_size, path, progress):
+  """Copy a file descriptor until EOF, in the kernel whenever possible."""
+  nbytes = 0
+  method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'sendfile'
+  while True:
+    try:
+      if method == 'copy_file_range':
+        count = os.copy_file_range(src_fd, dst_fd, chunk_size)
+      elif method == 'sendfile':
+        count = os.sendfile(dst_fd, src_fd, None, chunk_size)
+      else:
+        count = _copy_fd_buffered(src_fd, dst_fd, chunk_size)
+    except OSError as err:
+      if nbytes or method == 'read' or err.errno not in _UNSUPPORTED_ERRNOS:
+        raise
+      # Fall back to sendfile, then to a plain copy.
+      method = 'sendfile' if method == 'copy_file_range' else 'read'
+      continue
+    if not count:
+      break
+    nbytes += count
+    if progress:
+      progress(path, nbytes)
+  if progress:
+    progress(path, -1)
+  return nbytes
+
+def _copy_fd_buffered(src_fd, dst_fd, chunk_size):
+  """Copy one chunk through user space, returning the number of bytes copied."""
+  data = os.read(src_fd, chunk_size)
+  view = memoryview(data)
+  while view:
+    view = view[os.write(dst_fd, view):]
+  return len(data)
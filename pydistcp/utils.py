@@ -2,13 +2,36 @@
 # encoding: utf-8
 
 from pywhdfs.utils import hglob
+from pywhdfs.utils.utils import HdfsError
 from threading import Lock
+from .distclient import LIST_THREADS, _map_async
 from progressbar import AnimatedMarker, Bar, FileTransferSpeed, Percentage, ProgressBar, RotatingMarker, Timer
+import logging as lg
 import os.path as osp
 import os
 import sys
 import glob
 import fnmatch
+import json
+import re
+import time
+
+_logger = lg.getLogger(__name__)
+
+# Part size used when no measurement is available.
+DEFAULT_PART_SIZE = 2 ** 22
+
+# Largest chunk of data held in memory by a stream, and block in which
+# streamed responses are written out.
+STREAM_CHUNK_SIZE = 2 ** 20
+
+_TUNING_CACHE = osp.expanduser('~/.webhdfs_tuning.json')
+_PROBE_SIZES = (2 ** 18, 2 ** 22, 2 ** 24)
+_MIN_PART_SIZE = 2 ** 18
+_MAX_PART_SIZE = 2 ** 24
+
+# Minimum number of seconds between two redraws of the progress bar.
+_PROGRESS_INTERVAL = 1.0
 
 class _Progress(object):
 
@@ -27,6 +50,8 @@ class _Progress(object):
     self._complete_files = 0
     self._lock = Lock()
     self._data = {}
+    self._nbytes = 0
+    self._next_update = 0
 
     widgets = ['Progress: ', Percentage(), ' ', Bar(left='[',right=']'),
                ' ', Timer(format='Time: %s'), ' ', FileTransferSpeed()]
@@ -37,7 +62,6 @@ class _Progress(object):
       self.pbar = ProgressBar(widgets=widgets, maxval=nfiles).start()
 
   def __call__(self, hdfs_path, nbytes):
-    # TODO: Improve lock granularity.
     with self._lock:
       data = self._data
       if hdfs_path not in data:
@@ -47,27 +71,55 @@ class _Progress(object):
         self._transferring_files -= 1
         self._complete_files += 1
       else:
+        self._nbytes += nbytes - data.get(hdfs_path, 0)
         data[hdfs_path] = nbytes
+      # Redrawing the bar is far more expensive than counting, do it at most
+      # once per `_PROGRESS_INTERVAL`.
+      now = time.time()
+      if now < self._next_update:
+        return
+      self._next_update = now + _PROGRESS_INTERVAL
       if self._total_bytes:
-        self.pbar.update(sum(data.values()))
+        self.pbar.update(self._nbytes)
       else:
         self.pbar.update(self._complete_files)
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
   def __del__(self):
-    if self.pbar:
-      self.pbar.finish()
+    # `pbar` is missing when the constructor failed.
+    if getattr(self, 'pbar', None):
+      self.close()
+
+  def close(self):
+    """Finish the progress bar, leaving the terminal ready for more output."""
+    pbar, self.pbar = self.pbar, None
+    if pbar:
+      pbar.finish()
+      sys.stderr.flush()
 
   @classmethod
-  def from_hdfs(cls, client, hdfs_path):
+  def from_hdfs(cls, client, hdfs_path, n_threads=LIST_THREADS):
     """Instantiate from remote path.
     :param client: HDFS client.
     :param hdfs_path: HDFS path.
+    :param n_threads: Number of threads the client connection pool is sized
+      for, matches are summarized by at most `LIST_THREADS` threads.
     """
 
     total_content={'length': 0, 'fileCount': 0}
     matches = [ upload_file for upload_file in hglob.glob(client, hdfs_path) ]
-    for file_match in matches:
-      file_content = client.content(file_match)
+    # Each match is summarized by the namenode, without listing its files.
+    n_threads = min(n_threads, LIST_THREADS, len(matches))
+    if n_threads > 1:
+      contents = _map_async(n_threads, client.content, matches)
+    else:
+      contents = [client.content(file_match) for file_match in matches]
+    for file_content in contents:
       total_content['length'] +=  file_content['length']
       total_content['fileCount'] +=  file_content['fileCount']
     return cls(total_content['length'], total_content['fileCount'])
@@ -76,21 +128,13 @@ class _Progress(object):
   def from_local(cls, local_path, include_pattern="*", min_size=0):
     """Instantiate from a local path.
     :param local_path: Local path.
+    :param include_pattern: Pattern, as a string or compiled with
+      :func:`compile_pattern`, file names need to match to be counted.
+    :param min_size: Minimum size of the files to be counted.
     """
 
-    def _get_file_size(file_path):
-        if fnmatch.fnmatch( osp.basename(file_path), include_pattern):
-          try:
-            return osp.getsize(file_path)
-          except OSError as err:
-            if 'No such file or directory' in str(err):
-              # The files may have diappeared meanwhile
-              # 0 is a valid file size
-              return -1
-            else:
-              raise err
-        else:
-          return -1
+    pattern = compile_pattern(include_pattern)
+    min_size = int(min_size)
 
     uploads = [ upload_file for upload_file in glob.iglob(local_path) ]
     if len(uploads) == 0:
@@ -100,17 +144,121 @@ class _Progress(object):
     nfiles = 0
     for upload in uploads:
       if osp.isdir(upload):
-        for dpath, _, fnames in os.walk(upload):
-          for fname in fnames:
-            file_size = _get_file_size(osp.join(dpath, fname))
-            if int(file_size) >= int(min_size):
-                  nbytes += int(file_size)
-                  nfiles += 1
+        for entry in _scan(upload):
+          if pattern.match(entry.name):
+            try:
+              file_size = entry.stat().st_size
+            except OSError:
+              # The files may have diappeared meanwhile
+              continue
+            if file_size >= min_size:
+              nbytes += file_size
+              nfiles += 1
       elif osp.exists(upload):
-        file_size = _get_file_size(upload)
-        if int(file_size) >= int(min_size):
-          nbytes += int(file_size)
+        file_size = osp.getsize(upload)
+        if pattern.match(osp.basename(upload)) and file_size >= min_size:
+          nbytes += file_size
           nfiles += 1
       else:
         raise HdfsError('No file found at: %s', upload)
     return cls(nbytes, nfiles)
+
+
+def compile_pattern(pattern):
+  """Compile a shell-style file name pattern, as understood by `fnmatch`.
+
+  :param pattern: Pattern string, already compiled patterns are returned
+    unchanged.
+
+  """
+  if hasattr(pattern, 'match'):
+    return pattern
+  return re.compile(fnmatch.translate(pattern))
+
+def _scan(dir_path):
+  """Recursively yield the `os.DirEntry` of the files under a directory."""
+  for entry in os.scandir(dir_path):
+    if entry.is_dir(follow_symlinks=False):
+      for file_entry in _scan(entry.path):
+        yield file_entry
+    elif entry.is_file():
+      yield entry
+
+def configure_transfer(client, hdfs_path, cache_key=None, default=DEFAULT_PART_SIZE):
+  """Pick a transfer part size from the measured read bandwidth of a file.
+
+  Reads of increasing size are issued against the first file found under
+  `hdfs_path` and fitted to `t = alpha + beta * size`; the smallest power of 2
+  for which the transfer time is at least four times the per-request setup
+  time is returned.
+
+  :param client: HDFS client to probe.
+  :param hdfs_path: HDFS path (or pattern) of the files to be transferred.
+  :param cache_key: If set, the result is cached under this key in
+    `~/.webhdfs_tuning.json` and reused by subsequent calls.
+  :param default: Part size returned when no measurement could be made.
+  """
+  cache = _load_tuning_cache()
+  if cache_key is not None and cache_key in cache:
+    return int(cache[cache_key])
+
+  probe_path = _first_file(client, hdfs_path)
+  if probe_path is None:
+    return default
+
+  length = int(client.status(probe_path)['length'])
+  samples = []
+  for size in _PROBE_SIZES:
+    if size > length:
+      break
+    start = time.time()
+    with client.read(probe_path, offset=0, length=size, chunk_size=2 ** 16) as reader:
+      for _ in reader:
+        pass
+    samples.append((size, time.time() - start))
+
+  if len(samples) < 2:
+    return default
+
+  mean_size = float(sum(size for size, _ in samples)) / len(samples)
+  mean_time = sum(duration for _, duration in samples) / len(samples)
+  variance = sum((size - mean_size) ** 2 for size, _ in samples)
+  beta = sum((size - mean_size) * (duration - mean_time) for size, duration in samples) / variance
+  alpha = max(mean_time - beta * mean_size, 0)
+  if beta <= 0:
+    return default
+
+  part_size = _MIN_PART_SIZE
+  while part_size < _MAX_PART_SIZE and beta * part_size < 4 * alpha:
+    part_size *= 2
+
+  _logger.info('Tuned part size to %s bytes using %r (setup %.3fs, %.1f MB/s).',
+    part_size, probe_path, alpha, 1e-6 / beta)
+  if cache_key is not None:
+    cache[cache_key] = part_size
+    _save_tuning_cache(cache)
+  return part_size
+
+def _first_file(client, hdfs_path):
+  """Return the first file found under a pattern, or `None`."""
+  for match in hglob.iglob(client, hdfs_path):
+    if client.status(match)['type'] == 'FILE':
+      return match
+    for dpath, _, fnames in client.walk(match):
+      if fnames:
+        return osp.join(dpath, fnames[0])
+  return None
+
+def _load_tuning_cache():
+  try:
+    with open(_TUNING_CACHE) as reader:
+      return json.load(reader)
+  except (IOError, OSError, ValueError):
+    return {}
+
+def _save_tuning_cache(cache):
+  try:
+    with open(_TUNING_CACHE, 'w') as writer:
+      json.dump(cache, writer)
+  except (IOError, OSError) as err:
+    _logger.warning('Could not save transfer tuning to %r: %s', _TUNING_CACHE, err)
@@ -43,16 +43,18 @@ setup(
     'Intended Audience :: System Administrators',
     'License :: OSI Approved :: MIT License',
     'Programming Language :: Python',
-    'Programming Language :: Python :: 2.6',
-    'Programming Language :: Python :: 2.7',
-    'Programming Language :: Python :: 3.3',
-    'Programming Language :: Python :: 3.4',
+    'Programming Language :: Python :: 3',
+    'Programming Language :: Python :: 3 :: Only',
   ],
+  python_requires='>=3.7',
   install_requires=[
-    'docopt',
     'pywhdfs>=1.0.0',
     'progressbar>=2.0'
   ],
+  extras_require={
+    'crc32c': ['google-crc32c'],
+    'orjson': ['orjson'],
+  },
   entry_points={'console_scripts': 
      [ 'pydistcp = pydistcp.__main__:main' ]
   },